@@ -1,4 +1,14 @@
-from transformers import pipeline
+import copy
+import os
+import re
+import threading
+from collections import OrderedDict, deque
+from importlib.util import find_spec
+from typing import Callable
+
+import torch
+from transformers import (AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig, DynamicCache, StaticCache,
+                          StoppingCriteria, StoppingCriteriaList, TextStreamer)
 
 CHAT_TEMPLATE = '''This is a conversion between a really sad chatbot named SadGPT and a user
 ###
@@ -8,8 +18,162 @@ CHAT_TEMPLATE = '''This is a conversion between a really sad chatbot named SadGP
 [User]: What is your name?
 [EdgeGPT]: My name is SadGPT.'''
 
+# Number of previous turns the bot is prompted with before the history is trimmed
+MAX_TURNS = 8
+
+# Clean up of generated replies
+SCRUB_TABLE = str.maketrans({'\xa0': None})
+MULTI_SPACE = re.compile(r'  +')
+
+# Characters str.splitlines breaks on, any token containing one ends the reply
+LINE_TERMINATORS = '\n\r\v\f\x1c\x1d\x1e\x85\u2028\u2029'
+
+def is_installed(name:str) -> bool:
+    '''
+        Check whether a module can be imported without importing it
+
+        args:
+        ---------
+        name: str
+            Dotted name of the module
+
+        Returns
+        -------
+        bool
+            Whether the module and every parent package are installed
+    '''
+    # find_spec imports the parents of a dotted name and raises when they are missing
+    try:
+        return find_spec(name) is not None
+    except ModuleNotFoundError:
+        return False
+
+def clean_reply(response:str) -> str:
+    '''
+        Clean up a decoded reply
+
+        args:
+        ---------
+        response: str
+            Text generated after the prompt
+
+        Returns
+        -------
+        str
+            First line of the reply without stray whitespace
+    '''
+    response = response.splitlines()[0] if response else response
+    response = response.translate(SCRUB_TABLE)
+    return MULTI_SPACE.sub(' ', response)
+
+class PieceStreamer(TextStreamer):
+    '''
+        Streamer passing each decoded piece of a reply to a callback
+
+        Parameters
+        ----------
+        tokenizer: AutoTokenizer
+            Tokenizer to decode the reply with
+        on_piece: Callable[[str], None]
+            Called with each new piece of text
+    '''
+    def __init__(self, tokenizer:AutoTokenizer, on_piece:Callable[[str], None]):
+        super().__init__(tokenizer, skip_prompt=True, skip_special_tokens=True)
+        self.on_piece = on_piece
+
+    def on_finalized_text(self, text:str, stream_end:bool=False):
+        if text:
+            self.on_piece(text)
+
+class StopOnEvent(StoppingCriteria):
+    '''
+        Stops each row of a generation once its event is set
+
+        Parameters
+        ----------
+        events: list[threading.Event]
+            Event of each row, None for rows that run to the end
+    '''
+    def __init__(self, events:list):
+        self.events = events
+
+    def __call__(self, input_ids:torch.LongTensor, scores:torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        return torch.tensor([event is not None and event.is_set() for event in self.events],
+                            dtype=torch.bool, device=input_ids.device)
+
+class Conversation:
+    '''
+        Token ids of one chat, each turn is tokenized once when it is added
+
+        Parameters
+        ----------
+        prefix_ids: torch.Tensor
+            Token ids of the chat template, shape (1, prefix_len)
+
+        Attributes
+        ----------
+        history_ids: torch.Tensor
+            Token ids of the chat template and the turns the bot is prompted with
+        turn_ids: deque
+            Token ids of each of the last turns, used to rebuild history_ids
+        num_turns: int
+            Number of turns in history_ids
+        cache: DynamicCache
+            Key/values of the start of history_ids from previous turns, the bot's
+            StaticCache while they live in its static slot, None when the next reply
+            has to prefill the whole history
+    '''
+    def __init__(self, prefix_ids:torch.Tensor):
+        self.prefix_ids = prefix_ids
+        self.history_ids = prefix_ids
+        self.turn_ids = deque(maxlen=MAX_TURNS)
+        self.num_turns = 0
+        self.cache = None
+
+    def append(self, new_ids:torch.Tensor, reply_ids:torch.Tensor):
+        '''
+            Add a finished turn to the history
+
+            args:
+            ---------
+            new_ids: torch.Tensor
+                Token ids of the user message, shape (1, n)
+            reply_ids: torch.Tensor
+                Token ids of the bot reply
+        '''
+        turn = torch.cat([new_ids, reply_ids.view(1, -1)], dim=1)
+        self.history_ids = torch.cat([self.history_ids, turn], dim=1)
+        self.turn_ids.append(turn)
+        self.num_turns += 1
+
+    def trim(self, max_tokens:int):
+        '''
+            Rebuild the history from the chat template and the most recent turns
+
+            Keeps at most half of MAX_TURNS so the history is not rebuilt again on the next turn
+
+            args:
+            ---------
+            max_tokens: int
+                Maximum length of the rebuilt history_ids
+        '''
+        kept, length = [], self.prefix_ids.shape[1]
+        for turn in reversed(self.turn_ids):
+            if len(kept) == MAX_TURNS // 2 or length + turn.shape[1] > max_tokens:
+                break
+            kept.append(turn)
+            length += turn.shape[1]
+        kept.reverse()
+
+        self.turn_ids = deque(kept, maxlen=MAX_TURNS)
+        self.history_ids = torch.cat([self.prefix_ids] + kept, dim=1)
+        self.num_turns = len(kept)
+        # Positions moved, the cached key/values no longer line up with the ids
+        self.cache = None
+
 class ChatBot:
-    def __init__(self, model_name:str):
+    def __init__(self, model_name:str, max_new_tokens:int=128, top_k:int=50, load_in_8bit:bool=None,
+                 assistant_name:str=None, use_onnx:bool=False, max_cached:int=16):
         '''
             Initialize the chatbot
 
@@ -17,29 +181,478 @@ class ChatBot:
             ---------
             model_name: str
                 Name of the model to use
+            max_new_tokens: int
+                Maximum number of tokens to generate per reply
+            top_k: int
+                Number of most likely tokens to sample each reply token from
+            load_in_8bit: bool
+                Whether to load the weights as int8 with bitsandbytes, defaults to
+                whenever a GPU and bitsandbytes are available
+            assistant_name: str
+                Name of a small draft model sharing the GPT-2 vocabulary used for
+                speculative decoding of single replies (e.g. 'distilgpt2'), replaces the
+                compiled static cache decode, None to disable it
+            use_onnx: bool
+                Whether to run the model on ONNX Runtime, exported once next to the model
+                as model_name + '_onnx'. Disables the draft model, the cached key/values
+                and the half precision/ipex settings
+            max_cached: int
+                Number of conversations whose key/values are kept between turns
+        '''
+        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        if use_onnx and not (is_installed('optimum.onnxruntime') and is_installed('onnxruntime')):
+            raise ImportError('use_onnx needs optimum[onnxruntime]')
+        if load_in_8bit is None:
+            load_in_8bit = not use_onnx and self.device.type == 'cuda' and is_installed('bitsandbytes')
+        self.tokenizer = AutoTokenizer.from_pretrained('gpt2')
+        self.tokenizer.pad_token = self.tokenizer.eos_token
+        # Overlong messages keep their end, which leads into the reply
+        self.tokenizer.truncation_side = 'left'
+
+        # Half precision weights halve the bytes streamed per decode step, bfloat16 on CPU
+        # only where oneDNN has native kernels for it, emulating it is slower than float32
+        if self.device.type == 'cuda':
+            model_kwargs = {'torch_dtype': torch.float16}
+        elif torch.ops.mkldnn._is_mkldnn_bf16_supported():
+            model_kwargs = {'torch_dtype': torch.bfloat16}
+        else:
+            model_kwargs = {'torch_dtype': torch.float32}
+
+        # Fused attention kernels instead of materializing the full QK^T matrix,
+        # FlashAttention-2 only runs on Ampere (compute capability 8.0) or newer
+        if self.device.type == 'cuda' and is_installed('flash_attn') \
+                and torch.cuda.get_device_capability()[0] >= 8:
+            model_kwargs['attn_implementation'] = 'flash_attention_2'
+        else:
+            model_kwargs['attn_implementation'] = 'sdpa'
+
+        if use_onnx:
+            # ONNX Runtime fuses the GPT-2 blocks and manages the cache natively,
+            # on a GPU it has to run on the CUDA provider to take the CUDA inputs
+            from optimum.onnxruntime import ORTModelForCausalLM
+            if self.device.type == 'cuda':
+                ort_kwargs = {'provider': 'CUDAExecutionProvider', 'use_io_binding': True}
+            else:
+                ort_kwargs = {'provider': 'CPUExecutionProvider'}
+            # Exporting traces the whole model, so only do it on the first start
+            onnx_path = model_name.rstrip('/') + '_onnx'
+            if os.path.isdir(onnx_path):
+                self.model = ORTModelForCausalLM.from_pretrained(onnx_path, use_cache=True, **ort_kwargs)
+            else:
+                self.model = ORTModelForCausalLM.from_pretrained(model_name, export=True, use_cache=True, **ort_kwargs)
+                self.model.save_pretrained(onnx_path)
+            print('Running on ONNX Runtime without the draft model, key/values kept between turns or half precision weights')
+        elif load_in_8bit:
+            # Int8 weights halve the bytes streamed per decode step
+            self.model = AutoModelForCausalLM.from_pretrained(model_name,
+                                                              quantization_config=BitsAndBytesConfig(load_in_8bit=True),
+                                                              device_map='auto',
+                                                              **model_kwargs)
+        else:
+            self.model = AutoModelForCausalLM.from_pretrained(model_name, **model_kwargs).to(self.device)
+        if not use_onnx:
+            self.model.eval()
+            if self.device.type == 'cpu' and is_installed('intel_extension_for_pytorch'):
+                import intel_extension_for_pytorch as ipex
+                self.model = ipex.optimize(self.model, dtype=model_kwargs['torch_dtype'])
+
+        # Draft model proposing several tokens per forward pass of the main model
+        self.assistant = None
+        if assistant_name is not None and not use_onnx:
+            self.assistant = AutoModelForCausalLM.from_pretrained(assistant_name,
+                                                                  attn_implementation=model_kwargs['attn_implementation'],
+                                                                  torch_dtype=self.model.dtype).to(self.device)
+            self.assistant.eval()
+            print(f'Decoding single replies with {assistant_name} as draft model instead of the compiled static cache')
+
+        self.max_new_tokens = max_new_tokens
+        self.top_k = top_k
+
+        # Stop generating once the bot finishes its line, whichever token the line break is in
+        pieces = self.tokenizer.batch_decode([[i] for i in range(len(self.tokenizer))])
+        self.stop_ids = [self.tokenizer.eos_token_id] + [
+            i for i, piece in enumerate(pieces) if any(c in piece for c in LINE_TERMINATORS)
+        ]
+        self.stop_set = set(self.stop_ids)
+        self.stop_tensor = torch.tensor(self.stop_ids, device=self.device)
+
+        # Prompts plus replies have to fit in GPT-2's position table
+        self.max_length = self.model.config.n_positions
+
+        # Key/values of the chat template, computed once and shared by every conversation,
+        # ONNX Runtime models bring their own cache instead
+        self.prefix_ids = self.tokenizer(CHAT_TEMPLATE, return_tensors='pt').input_ids.to(self.device)
+        self.prefix_cache = None
+        if not use_onnx:
+            with torch.no_grad():
+                self.prefix_cache = self.model(self.prefix_ids, past_key_values=DynamicCache(),
+                                               use_cache=True).past_key_values
+
+        # Conversations holding a cache, least recently used dropped first
+        self.max_cached = max_cached
+        self.cached_conversations = OrderedDict()
+        self.cached_conversations_lock = threading.Lock()
+
+        # A batch of one decodes through a compiled step over one pre-allocated cache so
+        # every decode step has the same shapes. Int8 matmuls and flash attention's varlen
+        # kernels do not trace into one graph and assisted decoding runs its own loop,
+        # so those keep model.generate
+        self.decode_step = None
+        if not use_onnx and not load_in_8bit and self.assistant is None \
+                and model_kwargs['attn_implementation'] == 'sdpa':
+            self.static_cache = StaticCache(config=self.model.config, max_batch_size=1,
+                                            max_cache_len=self.max_length, device=self.device,
+                                            dtype=self.model.dtype)
+            self.decode_step = torch.compile(self.model, mode='reduce-overhead', fullgraph=True)
+            # Conversation whose key/values are in the static cache and how many tokens they cover
+            self.static_owner = None
+            self.static_length = 0
+            self.static_lock = threading.Lock()
+
+    def _generate_kwargs(self) -> dict:
+        '''
+            Generation settings shared by every reply
+
+            Returns
+            -------
+            dict
+                Keyword arguments for model.generate
+        '''
+        return {'use_cache': True,
+                'max_new_tokens': self.max_new_tokens,
+                'do_sample': True,
+                'top_k': self.top_k,
+                'eos_token_id': self.stop_ids,
+                'pad_token_id': self.tokenizer.pad_token_id}
+
+    def new_conversation(self) -> Conversation:
         '''
-        self.chatbot = pipeline('text-generation', model=model_name, tokenizer='GPT2')
-        self.chat_history = CHAT_TEMPLATE
+            Start an empty conversation
+
+            Returns
+            -------
+            Conversation
+                Conversation holding only the chat template
+        '''
+        return Conversation(self.prefix_ids)
+
+    def _encode_turn(self, conversation:Conversation, text:str) -> torch.Tensor:
+        '''
+            Tokenize only the new user message and make room for it and the reply
+
+            args:
+            ---------
+            conversation: Conversation
+                Conversation the message is added to
+            text: str
+                Text to generate a reply from
+
+            Returns
+            -------
+            torch.Tensor
+                Token ids of the new turn up to the bot's reply, shape (1, n)
+        '''
+        new_ids = self.tokenizer('###\n[User]: ' + text + '\n[EdgeGPT]: ', add_special_tokens=False,
+                                 truncation=True,
+                                 max_length=self.max_length - self.max_new_tokens - self.prefix_ids.shape[1],
+                                 return_tensors='pt').input_ids.to(self.device)
+
+        # Trim down to half of GPT-2's positions rather than just enough, so the history
+        # is rebuilt once every few turns instead of on every turn once it is full
+        length = conversation.history_ids.shape[1] + new_ids.shape[1] + self.max_new_tokens
+        if conversation.num_turns >= MAX_TURNS or length > self.max_length:
+            conversation.trim(self.max_length // 2 - new_ids.shape[1] - self.max_new_tokens)
+        return new_ids
+
+    def _conversation_cache(self, conversation:Conversation) -> DynamicCache:
+        '''
+            Get the cache to continue a conversation from
+
+            args:
+            ---------
+            conversation: Conversation
+                Conversation the next reply is generated in
+
+            Returns
+            -------
+            DynamicCache
+                Key/values of the start of the conversation, starting from a copy of the
+                template's cache when it has none, None for ONNX Runtime models
+        '''
+        if self.prefix_cache is None:
+            return None
+        with self.cached_conversations_lock:
+            if conversation.cache is None:
+                conversation.cache = copy.deepcopy(self.prefix_cache)
+            self.cached_conversations[conversation] = None
+            self.cached_conversations.move_to_end(conversation)
+            while len(self.cached_conversations) > self.max_cached:
+                evicted, _ = self.cached_conversations.popitem(last=False)
+                evicted.cache = None
+            return conversation.cache
+
+    def _reply_ids(self, output_ids:torch.Tensor) -> torch.Tensor:
+        '''
+            Cut generated ids after the token that ended the reply
+
+            args:
+            ---------
+            output_ids: torch.Tensor
+                Ids generated after the prompt, shape (n,)
+
+            Returns
+            -------
+            torch.Tensor
+                Ids of the reply, keeping the token that ended its line but not eos or padding
+        '''
+        stops = torch.isin(output_ids, self.stop_tensor).nonzero()
+        if len(stops) == 0:
+            return output_ids
+        end = stops[0, 0].item()
+        if output_ids[end].item() != self.tokenizer.eos_token_id:
+            end += 1
+        return output_ids[:end]
+
+    @torch.inference_mode()
+    def generate_batch(self, conversations:list[Conversation], texts:list[str],
+                       on_pieces:list[Callable[[str], None]]=None, stop_events:list[threading.Event]=None) -> list[str]:
+        '''
+            Generate replies for several independent conversations in one batch
+
+            args:
+            ---------
+            conversations: list[Conversation]
+                Conversations to reply in, each gets its new turn appended
+            texts: list[str]
+                New user message of each conversation
+            on_pieces: list[Callable[[str], None]]
+                Callback of each conversation receiving its reply as it is decoded, a batch of
+                one streams token by token while larger batches pass the whole reply at the end
+            stop_events: list[threading.Event]
+                Event of each conversation stopping its reply once set, a stopped reply is
+                not added to its conversation
+
+            Returns
+            -------
+            list[str]
+                Generated reply for each conversation
+        '''
+        on_pieces = on_pieces or [None] * len(conversations)
+        stop_events = stop_events or [None] * len(conversations)
+        # A single conversation can continue from its own cache
+        if len(conversations) == 1:
+            return [self.generate_reply(conversations[0], texts[0], on_pieces[0], stop_events[0])]
+
+        new_ids = [self._encode_turn(conversation, text) for conversation, text in zip(conversations, texts)]
+        rows = [torch.cat([conversation.history_ids, ids], dim=1)[0] for conversation, ids in zip(conversations, new_ids)]
+
+        # Left pad so every reply starts at the same position
+        length = max(len(row) for row in rows)
+        input_ids = torch.full((len(rows), length), self.tokenizer.pad_token_id, device=self.device)
+        attention_mask = torch.zeros_like(input_ids)
+        for i, row in enumerate(rows):
+            input_ids[i, length - len(row):] = row
+            attention_mask[i, length - len(row):] = 1
+
+        outputs = self.model.generate(input_ids=input_ids, attention_mask=attention_mask,
+                                      stopping_criteria=StoppingCriteriaList([StopOnEvent(stop_events)]),
+                                      **self._generate_kwargs())
+        replies = []
+        for conversation, ids, output_ids, on_piece, stop_event in zip(conversations, new_ids, outputs[:, length:],
+                                                                        on_pieces, stop_events):
+            reply_ids = self._reply_ids(output_ids)
+            reply = clean_reply(self.tokenizer.decode(reply_ids, skip_special_tokens=True))
+            if stop_event is not None and stop_event.is_set():
+                replies.append(reply)
+                continue
+            conversation.append(ids, reply_ids)
+            if on_piece is not None and reply:
+                on_piece(reply)
+            replies.append(reply)
+        return replies
+
+    def _load_static(self, conversation:Conversation):
+        '''
+            Move a conversation's key/values into the static cache, handing the previous
+            owner's back to it as a DynamicCache
+
+            args:
+            ---------
+            conversation: Conversation
+                Conversation the next reply is generated in
+        '''
+        owner = self.static_owner
+        if owner is not None and owner.cache is self.static_cache:
+            cache = DynamicCache()
+            for layer in range(len(self.static_cache.key_cache)):
+                cache.update(self.static_cache.key_cache[layer][:, :, :self.static_length].clone(),
+                             self.static_cache.value_cache[layer][:, :, :self.static_length].clone(), layer)
+            owner.cache = cache
+
+        # Stale positions past the copied ones are masked by cache_position, no reset needed
+        cache = conversation.cache if conversation.cache is not None else self.prefix_cache
+        self.static_length = cache.get_seq_length()
+        positions = torch.arange(self.static_length, device=self.device)
+        for layer in range(len(cache)):
+            keys, values = cache[layer]
+            self.static_cache.update(keys, values, layer, {'cache_position': positions})
+        self.static_owner = conversation
+        conversation.cache = self.static_cache
+        self._conversation_cache(conversation)
+
+    def _sample(self, logits:torch.Tensor) -> torch.Tensor:
+        '''
+            Sample the next token from the top_k most likely ones
+
+            args:
+            ---------
+            logits: torch.Tensor
+                Logits of the last position, shape (1, vocab_size)
+
+            Returns
+            -------
+            torch.Tensor
+                Sampled token id, shape (1, 1)
+        '''
+        values, indices = torch.topk(logits.float(), self.top_k, dim=-1)
+        choice = torch.multinomial(torch.softmax(values, dim=-1), 1)
+        return indices.gather(-1, choice)
+
+    @torch.no_grad()
+    def _decode_static(self, conversation:Conversation, input_ids:torch.Tensor, streamer:PieceStreamer=None,
+                       stop_event:threading.Event=None) -> list[int]:
+        '''
+            Prefill the uncached part of the prompt and decode with the compiled step
+
+            args:
+            ---------
+            conversation: Conversation
+                Conversation the reply is generated in
+            input_ids: torch.Tensor
+                History and new turn of the conversation, shape (1, n)
+            streamer: PieceStreamer
+                Streamer receiving the prompt then each new token
+            stop_event: threading.Event
+                Event stopping the decode once set
+
+            Returns
+            -------
+            list[int]
+                Generated token ids, ending with the stop token when one was sampled
+        '''
+        with self.static_lock:
+            if conversation.cache is self.static_cache:
+                # Still the owner, only refresh its place in the LRU order
+                self._conversation_cache(conversation)
+            else:
+                self._load_static(conversation)
+            if streamer is not None:
+                streamer.put(input_ids.cpu())
+
+            try:
+                length = input_ids.shape[1]
+                positions = torch.arange(self.static_length, length, device=self.device)
+                logits = self.model(input_ids=input_ids[:, self.static_length:], past_key_values=self.static_cache,
+                                    cache_position=positions, use_cache=True).logits
+                token = self._sample(logits[:, -1])
+
+                generated = []
+                for step in range(self.max_new_tokens):
+                    generated.append(token.item())
+                    if streamer is not None:
+                        streamer.put(token.cpu())
+                    if generated[-1] in self.stop_set or step == self.max_new_tokens - 1:
+                        break
+                    if stop_event is not None and stop_event.is_set():
+                        break
+                    position = torch.tensor([length + step], device=self.device)
+                    logits = self.decode_step(input_ids=token, past_key_values=self.static_cache,
+                                              cache_position=position, use_cache=True).logits
+                    token = self._sample(logits[:, -1])
+            except Exception:
+                conversation.cache = None
+                self.static_owner = None
+                raise
+            finally:
+                if streamer is not None:
+                    streamer.end()
+
+            # Every token but the last one went through the model
+            self.static_length = length + len(generated) - 1
+            return generated
+
+    def _generate_ids(self, conversation:Conversation, new_ids:torch.Tensor, streamer:PieceStreamer=None,
+                      stop_event:threading.Event=None) -> torch.Tensor:
+        '''
+            Generate a reply for one conversation, continuing from its cache
+
+            args:
+            ---------
+            conversation: Conversation
+                Conversation the reply is generated in
+            new_ids: torch.Tensor
+                Token ids of the new turn, see _encode_turn
+            streamer: PieceStreamer
+                Streamer receiving the reply as it is decoded
+            stop_event: threading.Event
+                Event stopping the reply once set
+
+            Returns
+            -------
+            torch.Tensor
+                Token ids of the reply, see _reply_ids
+        '''
+        input_ids = torch.cat([conversation.history_ids, new_ids], dim=1)
+        if self.decode_step is not None:
+            generated = self._decode_static(conversation, input_ids, streamer, stop_event)
+            return self._reply_ids(torch.tensor(generated, device=self.device))
+
+        generate_kwargs = self._generate_kwargs()
+        # Assisted generation only supports a batch of one
+        if self.assistant is not None:
+            generate_kwargs['assistant_model'] = self.assistant
+        try:
+            outputs = self.model.generate(input_ids=input_ids,
+                                          attention_mask=torch.ones_like(input_ids),
+                                          past_key_values=self._conversation_cache(conversation),
+                                          streamer=streamer,
+                                          stopping_criteria=StoppingCriteriaList([StopOnEvent([stop_event])]),
+                                          **generate_kwargs)
+        except Exception:
+            # The cache may hold part of the failed turn
+            conversation.cache = None
+            raise
+        return self._reply_ids(outputs[0, input_ids.shape[1]:])
 
-    def generate_reply(self, text:str) -> str:
+    @torch.no_grad()
+    def generate_reply(self, conversation:Conversation, text:str, on_piece:Callable[[str], None]=None,
+                       stop_event:threading.Event=None) -> str:
         '''
-            Generate a reply from the chatbot
+            Generate a reply continuing from the conversation's cache, so only the new
+            turn is prefilled
 
             args:
             ---------
+            conversation: Conversation
+                Conversation to reply in, gets the new turn appended
             text: str
                 Text to generate a reply from
+            on_piece: Callable[[str], None]
+                Called with each piece of the reply as it is decoded
+            stop_event: threading.Event
+                Event stopping the reply once set, a stopped reply is not added to the conversation
 
             Returns
             -------
             str
                 Generated reply
         '''
-        prompt = self.chat_history + '###\n[User]: ' + text + '\n[EdgeGPT]: '
-        prompt_len = len(prompt.split())
-        response = self.chatbot(prompt, max_length= 4 * prompt_len, num_return_sequences=1)[0]['generated_text']
-        response = response.split('[EdgeGPT]: ')[-1].split('\n')[0]
-        response = response.replace(u'\xa0', u'')
-        response = response.replace('  ', '')
-        self.chat_history = prompt + response
-        return response
+        new_ids = self._encode_turn(conversation, text)
+        streamer = PieceStreamer(self.tokenizer, on_piece) if on_piece is not None else None
+        reply_ids = self._generate_ids(conversation, new_ids, streamer, stop_event)
+        if stop_event is not None and stop_event.is_set():
+            # The cache went past the ids the conversation keeps
+            conversation.cache = None
+        else:
+            conversation.append(new_ids, reply_ids)
+        return clean_reply(self.tokenizer.decode(reply_ids, skip_special_tokens=True))
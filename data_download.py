@@ -1,5 +1,17 @@
 import requests, json
+from typing import Iterator
+from concurrent.futures import ThreadPoolExecutor
+import orjson
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+from ratelimit import limits, sleep_and_retry
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Reddit allows 100 OAuth requests per minute per client
+REQUESTS_PER_MINUTE = 100
 
 class RedditLoader:
     '''
@@ -16,13 +28,17 @@ class RedditLoader:
             Dictionary containing credentials for reddit API
         headers: dict
             Dictionary containing headers for reddit API
+        session: requests.Session
+            Session keeping connections to reddit API alive between requests
 
         Methods
         -------
         get_token() -> str
             Get token from reddit API
-        get_single_batch(subreddit:str, sort_by:str, limit:int, before: str=None) -> list[list]
+        get_single_batch(subreddit:str, sort_by:str, limit:int, after: str=None) -> tuple[tuple[list, list, list], str]
             Get a single batch of data from reddit API
+        iter_batches(type:str, subreddit:str, sort_by:str) -> Iterator[tuple[list, list, list]]
+            Iterate over batches of data from reddit API
         get_all_data(subreddit:str, sort_by:str) -> pd.DataFrame
             Get all data from reddit API
     '''
@@ -30,9 +46,18 @@ class RedditLoader:
         with open(path) as f:
             self.config = json.load(f)
         self.headers = {'User-Agent': 'MyBot/0.0.1'}
+
+        # Reuse connections across requests and back off when reddit is rate limiting
+        self.session = requests.Session()
+        retry = Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+        adapter = HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=retry)
+        self.session.mount('https://', adapter)
+        self.session.headers.update(self.headers)
+
         self.headers['Authorization'] = 'bearer ' + self.get_token()
+        self.session.headers.update(self.headers)
 
-        if requests.get('https://oauth.reddit.com/api/v1/me', headers=self.headers).status_code == 200:
+        if self.session.get('https://oauth.reddit.com/api/v1/me').status_code == 200:
             print('Success authenticated')
 
 
@@ -51,9 +76,8 @@ class RedditLoader:
                 'password': self.config['password']
         }
 
-        headers = self.headers
-        res = requests.post('https://www.reddit.com/api/v1/access_token',
-                            auth=auth, data=data, headers=headers)
+        res = self.session.post('https://www.reddit.com/api/v1/access_token',
+                                auth=auth, data=data)
         
         try:
             return res.json()['access_token']
@@ -62,7 +86,54 @@ class RedditLoader:
             raise Exception('Invalid credentials')
         
 
-    def get_single_batch_post_from_reddit(self, subreddit:str, sort_by:str, limit, before: str=None) -> list[list]:
+    @sleep_and_retry
+    @limits(calls=REQUESTS_PER_MINUTE, period=60)
+    def get_json(self, uri:str, params:dict):
+        '''
+            Make a rate limited GET request to reddit API
+
+            args:
+            ---------
+            uri: str
+                Endpoint to request
+            params: dict
+                Query parameters of the request
+
+            Returns
+            -------
+            dict | list
+                Decoded JSON response
+        '''
+        return orjson.loads(self.session.get(uri, params=params).content)
+
+    def get_comments(self, post_id:str, sort_by:str) -> list[str]:
+        '''
+            Get the top 5 comments of a post
+
+            args:
+            ---------
+            post_id: str
+                Id of the post to get comments from
+            sort_by: str
+                How to sort the comments
+
+            Returns
+            -------
+            list[str]
+                Text of each comment
+        '''
+        uri = f'https://oauth.reddit.com/comments/{post_id}'
+        params = {'limit': 5, 'raw_json': 1, 'sort': sort_by}
+        raw_comments = self.get_json(uri, params)
+
+        comments = []
+        for comment in raw_comments[1]['data']['children']:
+            body = comment['data'].get('body')
+            if body is not None:
+                comments.append(body)
+        return comments
+
+    def get_single_batch_post_from_reddit(self, subreddit:str, sort_by:str, limit, after: str=None) -> tuple[tuple[list, list, list], str]:
         '''
             Get a single batch of data from reddit API
 
@@ -74,33 +145,37 @@ class RedditLoader:
                 How to sort the data
             limit: int
                 Number of posts to get
-            before: str
-                Name of post to get data before
+            after: str
+                Name of post to get data after
             
             Returns
             -------
-            list[list]
-                List of lists containing name, title, and selftext of each post
+            tuple[list, list, list]
+                Lists of the name, title, and selftext of each post
+            str
+                Name of post to get the next batch after, None on the last page
         '''
         # Set up the parameters
         uri = f'https://oauth.reddit.com/r/{subreddit}/{sort_by}'
         params = {'limit': limit, 'raw_json': 1}
-        if before:
-            params['before'] = before
+        if after:
+            params['after'] = after
 
         # Make request to reddit API
-        res = requests.get(uri, headers=self.headers, params=params)
-        raw_data = res.json()
+        raw_data = self.get_json(uri, params)
 
         # Get name, title, and selftext from each post
-        data = []
+        names, titles, texts = [], [], []
         for post in raw_data['data']['children']:
-            data.append([post['data']['name'], post['data']['title'], post['data']['selftext']])
+            post_data = post['data']
+            names.append(post_data['name'])
+            titles.append(post_data['title'])
+            texts.append(post_data['selftext'])
 
 
-        return data
+        return (names, titles, texts), raw_data['data']['after']
     
-    def get_single_batch_post_comment_from_reddit(self, subreddit:str, sort_by:str, limit:int, before: str=None) -> list[list]:
+    def get_single_batch_post_comment_from_reddit(self, subreddit:str, sort_by:str, limit:int, after: str=None) -> tuple[tuple[list, list, list], str]:
         '''
             Get a single batch of data from reddit API
 
@@ -112,47 +187,48 @@ class RedditLoader:
                 How to sort the comments
             limit: int
                 Number of posts to get
-            before: str
-                Name of post to get data before
+            after: str
+                Name of post to get data after
             
             Returns
             -------
-            list[list]
-                List of lists containing name, title, and selftext of each post
+            tuple[list, list, list]
+                Lists of the post name, post title, and text of each comment
+            str
+                Name of post to get the next batch after, None on the last page
         '''
         # Set up the parameters
         uri = f'https://oauth.reddit.com/r/{subreddit}/top'
         params = {'limit': limit, 'raw_json': 1, 't': 'all'}
-        if before:
-            params['before'] = before
+        if after:
+            params['after'] = after
 
         # Make request to reddit API
-        res = requests.get(uri, headers=self.headers, params=params)
-        raw_data = res.json()
+        raw_data = self.get_json(uri, params)
 
-        # Get top 5 comments for each post
-        data = []
+        posts = []
         for post in raw_data['data']['children']:
-            post_name = post['data']['name']
-            post_title = post['data']['title']
-            post_id = post['data']['id']
+            post_data = post['data']
+            post_name = post_data['name']
+            post_title = post_data['title']
+            post_id = post_data['id']
+            posts.append((post_name, post_title, post_id))
 
-            # Get comments
-            uri = f'https://oauth.reddit.com/comments/{post_id}'
-            params = {'limit': 5, 'raw_json': 1, 'sort': sort_by}
-            res = requests.get(uri, headers=self.headers, params=params)
-            raw_comments = res.json()
+        # Get top 5 comments for each post, fetching the posts concurrently
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            comments = executor.map(lambda post: self.get_comments(post[2], sort_by), posts)
 
             # Add post name, post title, and comment text to data
-            # print(raw_comments)
-            for comment in raw_comments[1]['data']['children']:
-                if 'body' in comment['data']:
-                    data.append([post_name, post_title, comment['data']['body']])
-        return data
+            names, titles, texts = [], [], []
+            for (post_name, post_title, _), post_comments in zip(posts, comments):
+                names.extend([post_name] * len(post_comments))
+                titles.extend([post_title] * len(post_comments))
+                texts.extend(post_comments)
+        return (names, titles, texts), raw_data['data']['after']
 
-    def get_all_data(self, type:str, subreddit:str, sort_by:str, verbose:bool=False) -> pd.DataFrame:
+    def iter_batches(self, type:str, subreddit:str, sort_by:str, verbose:bool=False) -> Iterator[tuple[list, list, list]]:
         '''
-            Get all data from reddit API
+            Iterate over batches of data from reddit API until the last page
 
             args:
             ---------
@@ -165,10 +241,10 @@ class RedditLoader:
             verbose: bool
                 Whether to print progress
 
-            Returns
+            Yields
             -------
-            pd.DataFrame
-                Dataframe containing name, title, and selftext of each post
+            tuple[list, list, list]
+                Lists of the name, title, and text of each post or comment
         '''
         if type == 'post':
             get_data = self.get_single_batch_post_from_reddit
@@ -176,32 +252,59 @@ class RedditLoader:
             get_data = self.get_single_batch_post_comment_from_reddit
         else:
             raise Exception('Invalid type')
-        data = []
-        before = None
+        after = None
         if verbose:
             print('Getting data...')
-            batch = 0
+            batch_count = 0
         data_size = 0
         while True:
             try:
-                data += get_data(subreddit, sort_by, 100, before)
-                before = data[-1][0]
-
-                if verbose:
-                    batch += 1
-                    print(f'Batch {batch} complete, loaded {len(data)} posts.')
-                if len(data) == data_size:
-                    break
-                data_size = len(data)
+                batch, after = get_data(subreddit, sort_by, 100, after)
             except Exception as e:
                 print(e)
                 break
+            data_size += len(batch[0])
+
+            if verbose:
+                batch_count += 1
+                print(f'Batch {batch_count} complete, loaded {data_size} posts.')
+            if batch[0]:
+                yield batch
+            # Reddit stops returning an after token on the last page
+            if after is None:
+                break
+
+    def get_all_data(self, type:str, subreddit:str, sort_by:str, verbose:bool=False) -> pd.DataFrame:
+        '''
+            Get all data from reddit API
+
+            args:
+            ---------
+            type: str
+                Whether to get posts or comments
+            subreddit: str
+                Subreddit to get data from
+            sort_by: str
+                How to sort the data
+            verbose: bool
+                Whether to print progress
+
+            Returns
+            -------
+            pd.DataFrame
+                Dataframe containing name, title, and selftext of each post
+        '''
+        data = ([], [], [])
+        for batch in self.iter_batches(type, subreddit, sort_by, verbose=verbose):
+            for column, values in zip(data, batch):
+                column.extend(values)
 
         return RedditLoader.make_dataframe(type, data)
     
     def save_data(self, type:str, subreddit:str, sort_by:str, path:str, verbose:bool=False):
         '''
-            Save data from reddit API to csv
+            Stream data from reddit API batch by batch to csv, or to parquet when path
+            ends with .parquet
 
             args:
             ---------
@@ -216,17 +319,28 @@ class RedditLoader:
             verbose: bool
                 Whether to print progress
         '''
-        df = self.get_all_data(type, subreddit, sort_by, verbose=verbose)
-        df.to_csv(path, index=False)
+        schema = pa.schema([(column, pa.string()) for column in RedditLoader.get_columns(type)])
+        if path.endswith('.parquet'):
+            writer = pq.ParquetWriter(path, schema)
+        else:
+            writer = pacsv.CSVWriter(path, schema, write_options=pacsv.WriteOptions(include_header=True))
+
+        with writer:
+            for batch in self.iter_batches(type, subreddit, sort_by, verbose=verbose):
+                writer.write_batch(pa.record_batch(list(batch), schema=schema))
 
     @staticmethod
-    def make_dataframe(type:str, data:list[list]) -> pd.DataFrame:
+    def get_columns(type:str) -> list[str]:
         if type == 'post':
-            return pd.DataFrame(data, columns=['name', 'title', 'text'])
+            return ['name', 'title', 'text']
         elif type == 'comment':
-            return pd.DataFrame(data, columns=['name', 'title', 'comment'])
+            return ['name', 'title', 'comment']
         else:
             raise Exception('Invalid type')
+
+    @staticmethod
+    def make_dataframe(type:str, data:tuple[list, list, list]) -> pd.DataFrame:
+        return pd.DataFrame(dict(zip(RedditLoader.get_columns(type), data)), copy=False)
         
 if __name__ == '__main__':
     loader = RedditLoader('reddit_cred.json')
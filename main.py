@@ -1,33 +1,204 @@
 # Create Flask app to host chatbot
-from flask import Flask, render_template, request, redirect
-from chat import ChatBot
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from typing import Callable
+
+from flask import Flask, Response, stream_template, request, redirect, session
+from chat import ChatBot, Conversation, clean_reply
+
+class ReplyBatcher:
+    '''
+        Gathers concurrent chat requests and answers them with one batched generation,
+        every reply, streamed or not, is generated by its single worker thread
+
+        Parameters
+        ----------
+        model: ChatBot
+            Chatbot used to generate the replies
+        max_batch_size: int
+            Maximum number of replies generated together
+        max_wait: float
+            Seconds to wait for more messages after the first one arrives
+    '''
+    def __init__(self, model:ChatBot, max_batch_size:int=8, max_wait:float=0.01):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, conversation:Conversation, text:str, on_piece:Callable[[str], None]=None,
+               stop_event:threading.Event=None) -> Future:
+        '''
+            Queue a message to be answered in the next batch
+
+            args:
+            ---------
+            conversation: Conversation
+                Conversation to reply in
+            text: str
+                Text to generate a reply from
+            on_piece: Callable[[str], None]
+                Called with each piece of the reply as it is decoded
+            stop_event: threading.Event
+                Event stopping the reply once set
+
+            Returns
+            -------
+            Future
+                Future resolving to the generated reply
+        '''
+        future = Future()
+        self.queue.put((conversation, text, on_piece, stop_event, future))
+        return future
+
+    def _run(self):
+        while True:
+            items = [self.queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(items) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            # Requests cancelled while queued are dropped
+            items = [item for item in items if item[-1].set_running_or_notify_cancel()]
+            if not items:
+                continue
+
+            conversations, texts, on_pieces, stop_events, futures = zip(*items)
+            try:
+                replies = self.model.generate_batch(list(conversations), list(texts), list(on_pieces), list(stop_events))
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            for future, reply in zip(futures, replies):
+                future.set_result(reply)
+
 
 app = Flask(__name__)
+app.secret_key = os.environ.get('SADGPT_SECRET_KEY', os.urandom(16))
 
 model_name = 'sadgpt_model'
-chat_history = []
 model = ChatBot(model_name)
+batcher = ReplyBatcher(model)
+
+# Seconds a stream waits for the next piece of its reply before giving up
+STREAM_TIMEOUT = 60.0
+
+# Turns kept per session and number of sessions kept, least recently used dropped first
+MAX_HISTORY = 20
+MAX_SESSIONS = 1000
+chat_sessions = OrderedDict()
+chat_sessions_lock = threading.Lock()
+
+class ChatSession:
+    '''
+        Chat of one visitor
+
+        Attributes
+        ----------
+        history: deque
+            Last (user message, bot reply) pairs shown on the page
+        conversation: Conversation
+            Token ids the bot continues the chat from
+        lock: threading.Lock
+            Held while a reply is generated so a conversation gets one turn at a time
+    '''
+    def __init__(self):
+        self.history = deque(maxlen=MAX_HISTORY)
+        self.conversation = model.new_conversation()
+        self.lock = threading.Lock()
+
+def get_chat_session() -> ChatSession:
+    '''
+        Get the chat of the current session
+
+        Returns
+        -------
+        ChatSession
+            Chat history and conversation of the session
+    '''
+    if 'id' not in session:
+        session['id'] = uuid.uuid4().hex
+    with chat_sessions_lock:
+        if session['id'] not in chat_sessions:
+            chat_sessions[session['id']] = ChatSession()
+            if len(chat_sessions) > MAX_SESSIONS:
+                chat_sessions.popitem(last=False)
+        chat_sessions.move_to_end(session['id'])
+        return chat_sessions[session['id']]
 
 @app.route('/')
 def index():
-    return render_template('index.html', chat_history=chat_history, user_icon='user_icon.png', bot_icon='sadgpt.png')
+    chat_history = list(get_chat_session().history)
+    return stream_template('index.html', chat_history=chat_history, user_icon='user_icon.png', bot_icon='sadgpt.png')
 
 @app.route('/chat', methods=['POST'])
 def chat():
     text = request.form['text']
-    reply = model.generate_reply(text)
-    global chat_history
-    chat_history.append((text, reply))
+    chat_session = get_chat_session()
+    with chat_session.lock:
+        reply = batcher.submit(chat_session.conversation, text).result()
+        chat_session.history.append((text, reply))
     return redirect('/')
 
 
+@app.route('/stream')
+def stream_chat():
+    text = request.args['text']
+    chat_session = get_chat_session()
+
+    # Send each piece of the reply as a server-sent event as soon as it is decoded
+    def events():
+        with chat_session.lock:
+            pieces = queue.Queue()
+            stop = threading.Event()
+            future = batcher.submit(chat_session.conversation, text, on_piece=pieces.put, stop_event=stop)
+            future.add_done_callback(lambda _: pieces.put(None))
+            try:
+                line_ended = False
+                while True:
+                    piece = pieces.get(timeout=STREAM_TIMEOUT)
+                    if piece is None:
+                        break
+                    if line_ended:
+                        continue
+                    # Anything after a line break would start a new SSE field
+                    line = piece.splitlines()[0]
+                    line_ended = len(line) < len(piece)
+                    line = clean_reply(line)
+                    if line:
+                        yield 'data: ' + line + '\n\n'
+                # Runs of spaces can straddle two pieces, so keep the reply cleaned as a whole
+                chat_session.history.append((text, future.result()))
+            finally:
+                # Stop generating once the client is gone, and keep the session locked
+                # until the worker is done with its conversation
+                stop.set()
+                if not future.cancel():
+                    future.exception()
+        yield 'event: done\ndata: \n\n'
+
+    return Response(events(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+
 @app.route('/restart')
 def restart_chat():
-    global model
-    model = None
-    model = ChatBot(model_name)
-    global chat_history
-    chat_history = []
+    chat_session = get_chat_session()
+    with chat_session.lock:
+        chat_session.history.clear()
+        chat_session.conversation = model.new_conversation()
     return redirect('/')
 
 
@@ -35,4 +206,3 @@ if __name__ == '__main__':
     app.run(debug=True)
 
 # {% for user_msg, bot_msg in chat_history %}
-# 
\ No newline at end of file